@@ -1,66 +1,110 @@
 import random
-from functools import reduce
+from array import array
 from itertools import count
-from datetime import datetime, timedelta
+from math import inf, log, sqrt
+from time import monotonic_ns
 
 
-all_win_conds = [
-    [0, 1, 2],
-    [3, 4, 5],
-    [6, 7, 8],
-    [0, 3, 6],
-    [1, 4, 7],
-    [2, 5, 8],
-    [0, 4, 8],
-    [6, 4, 2],
-]
+# bitmasks of the three cells making up each row, column and diagonal
+WIN_MASKS = (0x007, 0x038, 0x1C0, 0x049, 0x092, 0x124, 0x111, 0x054)
 
 
-win_cond_map = {
-    i: list(filter(lambda cond: i in cond, all_win_conds)) for i in range(9)
-}
+# the win masks running through each cell
+INDEX_MASKS = tuple(
+    tuple(mask for mask in WIN_MASKS if mask >> i & 1) for i in range(9)
+)
+
+
+# the eight rotations and reflections of the board, each mapping a cell index
+# to the index it moves to
+SYMMETRIES = tuple(
+    tuple(f(i // 3, i % 3) for i in range(9))
+    for f in (
+        lambda r, c: 3 * r + c,
+        lambda r, c: 3 * c + 2 - r,
+        lambda r, c: 3 * (2 - r) + 2 - c,
+        lambda r, c: 3 * (2 - c) + r,
+        lambda r, c: 3 * r + 2 - c,
+        lambda r, c: 3 * (2 - r) + c,
+        lambda r, c: 3 * c + r,
+        lambda r, c: 3 * (2 - c) + 2 - r,
+    )
+)
+
+
+# maps cell indices back through each symmetry
+INVERSE_SYMMETRIES = tuple(
+    tuple(sym.index(i) for i in range(9)) for sym in SYMMETRIES
+)
+
+
+# every 9-bit bitboard as it looks after each symmetry
+SYMMETRIC_BOARDS = tuple(
+    tuple(sum(1 << sym[i] for i in range(9) if board >> i & 1) for board in range(512))
+    for sym in SYMMETRIES
+)
 
 
 class Game:
-    def __init__(self, board=None, turn='x'):
-        self.__board = board or ['']*9
+    def __init__(self, x=0, o=0, turn=0):
+        # one 9-bit bitboard per player, bit i set when cell i+1 is taken
+        self.__x = x
+        self.__o = o
+        # 0 when it is x's turn, 1 when it is o's
         self.__turn = turn
 
     def current_turn(self):
-        return self.__turn
+        return 'xo'[self.__turn]
 
     def state(self):
-        return ''.join(map(lambda x: x or '_', self.__board))
+        return (self.__turn << 18) | (self.__x << 9) | self.__o
 
     def valid_moves(self):
-        return map(lambda i: self.__cell(i), filter(lambda i: not self.__board[i], range(9)))
+        empty = ~(self.__x | self.__o) & 0x1FF
+        while empty:
+            bit = empty & -empty
+            empty ^= bit
+            yield str(bit.bit_length())
 
     def clone(self):
-        return Game(self.__board.copy(), self.__turn)
+        return Game(self.__x, self.__o, self.__turn)
 
-    def __check_index_win(self, index, player):
-        return self.__check_win(win_cond_map[index], player)
-
-    def __check_win(self, conds, player):
-        return any(map(lambda cond: all(map(lambda i: self.__board[i] == player, cond)), conds))
+    def __check_index_win(self, index, board):
+        for mask in INDEX_MASKS[index]:
+            if board & mask == mask:
+                return True
+        return False
 
     def is_no_more_moves(self):
-        return all(self.__board)
+        return (self.__x | self.__o) == 0x1FF
 
     def move(self, cell):
         index = int(cell) - 1
-        if not (0 <= index <= 8) or self.__board[index]:
+        if not (0 <= index <= 8):
             raise Exception('bad move')
 
-        self.__board[index] = self.__turn
+        bit = 1 << index
+        if (self.__x | self.__o) & bit:
+            raise Exception('bad move')
+
+        if self.__turn:
+            self.__o |= bit
+            board = self.__o
+        else:
+            self.__x |= bit
+            board = self.__x
 
         try:
-            return self.__check_index_win(index, self.__turn)
+            return self.__check_index_win(index, board)
         finally:
-            self.__turn = 'x' if self.__turn == 'o' else 'o'
+            self.__turn ^= 1
 
     def __cell(self, index):
-        return self.__board[index] or str(1 + index)
+        if self.__x >> index & 1:
+            return 'x'
+        if self.__o >> index & 1:
+            return 'o'
+        return str(1 + index)
 
     def __print_row(self, y):
         print(' ' + ' | '.join(self.__cell(i + 3*y) for i in range(3)) + ' ')
@@ -73,60 +117,154 @@ class Game:
         self.__print_row(2)
 
 
-def winrate(record):
-    if not record[1]:
-        return 0.5
-    return record[0] / record[1]
+# exploration constant of the UCT formula
+EXPLORATION = sqrt(2)
+
+
+# every 9-bit bitboard read as a base 3 number with a 1 for each set bit
+TRITS = tuple(
+    sum(3 ** i for i in range(9) if board >> i & 1) for board in range(512)
+)
+
+
+# the indices of the set bits of every 9-bit bitmask
+BIT_INDICES = tuple(
+    tuple(i for i in range(9) if mask >> i & 1) for mask in range(512)
+)
+
+
+# number of boards with each cell empty, x or o
+STATE_COUNT = 3 ** 9
+
+
+def table_index(state):
+    # the turn bit is left out since the piece counts already say whose turn
+    # it is in any game where x moves first
+    return TRITS[(state >> 9) & 0x1FF] + 2 * TRITS[state & 0x1FF]
+
+
+def legal_moves(state):
+    return ~((state >> 9) | state) & 0x1FF
+
+
+def canonical(state):
+    # the smallest of the state's symmetric variants, along with the index of
+    # the symmetry that produces it
+    turn = state & ~0x3FFFF
+    x = (state >> 9) & 0x1FF
+    o = state & 0x1FF
+
+    best = state
+    best_sym = 0
+    for sym in range(1, 8):
+        boards = SYMMETRIC_BOARDS[sym]
+        variant = turn | (boards[x] << 9) | boards[o]
+        if variant < best:
+            best = variant
+            best_sym = sym
+
+    return best, best_sym
 
 
 class MonteCarlo:
-    def __init__(self):
-        self.__memory = {}
+    def __init__(self, seed=None):
+        self.__rng = random.Random(seed)
+
+        # dense tables indexed by the table_index of a canonical state; wins
+        # and visits hold a row of nine cells per state, numbered as on the
+        # canonical board, totals counts visits to the state itself and legal
+        # is its bitmask of empty cells, left 0 until the state is first seen
+        self.__wins = array('d', [0.0]) * (STATE_COUNT * 9)
+        self.__visits = array('i', [0]) * (STATE_COUNT * 9)
+        self.__totals = array('i', [0]) * STATE_COUNT
+        self.__legal = array('H', [0]) * STATE_COUNT
 
     def next_move(self, state):
-        records = self.__memory[state]
-        return reduce(
-            lambda a, b: a if winrate(records[a]) > winrate(records[b]) else b,
-            records.keys(),
-        )
-
-    def __pick_move(self, state):
-        records = self.__memory[state]
-        return random.choices(
-            list(records.keys()),
-            list(map(winrate, records.values())),
-        )[0]
+        state, sym = canonical(state)
+        row = table_index(state)
+        legal = self.__legal[row]
+        visits = self.__visits
+        base = row * 9
+
+        best = -1
+        for i in BIT_INDICES[legal]:
+            if visits[base + i] > best:
+                best = visits[base + i]
+                move = i
+
+        return str(1 + INVERSE_SYMMETRIES[sym][move])
+
+    def __pick_move(self, row, legal):
+        wins = self.__wins
+        visits = self.__visits
+        base = row * 9
+        log_total = log(self.__totals[row] + 1)
+
+        # pick the move with the highest upper confidence bound, breaking ties
+        # at random; smoothing the counts as if every move started with half a
+        # win out of one visit leaves unvisited moves a finite but high bound
+        rand = self.__rng.random
+        best = -inf
+        ties = 0
+        for i in BIT_INDICES[legal]:
+            n = visits[base + i] + 1
+            uct = (wins[base + i] + .5) / n + EXPLORATION * sqrt(log_total / n)
+
+            if uct > best:
+                best = uct
+                move = i
+                ties = 1
+            elif uct == best:
+                ties += 1
+                if rand() * ties < 1:
+                    move = i
+
+        return move
 
     def __simulate(self, game):
-        # whoami
-        me = game.current_turn()
-
-        # keep track of moves made
+        # bind everything the playout touches to locals so the loop below
+        # does no attribute lookups
+        legal_table = self.__legal
+        pick_move = self.__pick_move
+        get_state = game.state
+        make_move = game.move
+
+        # keep track of moves made, along with the table row they were made in
         my_moves = []
         their_moves = []
+        record_mine = my_moves.append
+        record_theirs = their_moves.append
 
-        # play game
+        # play game, starting with my move
+        is_me = True
         i_won = None
-        while not game.is_no_more_moves():
-            current_state = game.state()
-            if current_state not in self.__memory:
-                self.__memory[current_state] = {
-                    move: (0, 0) for move in game.valid_moves()
-                }
+        while True:
+            # rows are only filled in for states with moves left, so a known
+            # state never needs checking for a full board
+            current_state, sym = canonical(get_state())
+            row = table_index(current_state)
+            legal = legal_table[row]
+            if not legal:
+                legal = legal_moves(current_state)
+                if not legal:
+                    break
 
-            move = self.__pick_move(current_state)
+                legal_table[row] = legal
+
+            move = pick_move(row, legal)
 
             # take note of who made what move
-            is_me = game.current_turn() == me
             if is_me:
-                my_moves.append((current_state, move))
+                record_mine((row, move))
             else:
-                their_moves.append((current_state, move))
+                record_theirs((row, move))
 
-            if game.move(move):
-                i_won = True if is_me else False
+            if make_move(INVERSE_SYMMETRIES[sym][move] + 1):
+                i_won = is_me
                 break
 
+            is_me = not is_me
+
         # determine score
         if i_won is None:
             scores = (0, 0)
@@ -135,29 +273,44 @@ class MonteCarlo:
         else:
             scores = (-1, 1)
 
-        # update memory
-        for i, (state, move) in zip(range(len(my_moves)), reversed(my_moves)):
-            self.__memory[state][move] = (
-                self.__memory[state][move][0] + .5 +
-                (scores[0] * 0.5 / (i + 1)),
-                self.__memory[state][move][1] + 1,
-            )
-
-        for i, (state, move) in zip(range(len(their_moves)), reversed(their_moves)):
-            self.__memory[state][move] = (
-                self.__memory[state][move][0] + .5 +
-                (scores[1] * 0.5 / (i + 1)),
-                self.__memory[state][move][1] + 1,
-            )
-
-    def think(self, game, time_limit):
-        end_time = datetime.now() + time_limit
+        # update the tables in place
+        wins = self.__wins
+        visits = self.__visits
+        totals = self.__totals
+        for i, (row, move) in zip(range(len(my_moves)), reversed(my_moves)):
+            wins[row * 9 + move] += .5 + (scores[0] * 0.5 / (i + 1))
+            visits[row * 9 + move] += 1
+            totals[row] += 1
+
+        for i, (row, move) in zip(range(len(their_moves)), reversed(their_moves)):
+            wins[row * 9 + move] += .5 + (scores[1] * 0.5 / (i + 1))
+            visits[row * 9 + move] += 1
+            totals[row] += 1
+
+    def think(self, game, time_limit_ms):
+        budget = time_limit_ms * 1000000
+        now = monotonic_ns()
+        end_time = now + budget
+
+        # only read the clock between batches of simulations, resizing the
+        # batch so that each one takes around 1/64 of the budget
+        target = budget >> 6
+        batch = 1
         while True:
-            self.__simulate(game.clone())
+            batch_start = now
+            for _ in range(batch):
+                self.__simulate(game.clone())
 
-            if datetime.now() > end_time:
+            now = monotonic_ns()
+            if now > end_time:
                 break
 
+            elapsed = now - batch_start
+            if elapsed * 2 < target:
+                batch <<= 1
+            elif elapsed > target * 2 and batch > 1:
+                batch >>= 1
+
 
 def clear():
     print('\033[H\033[J', end='')
@@ -174,7 +327,7 @@ def play_a_new_game():
         if i % 2:
             print('thinking...')
 
-            bot.think(g, timedelta(milliseconds=100))
+            bot.think(g, 100)
             if g.move(bot.next_move(g.state())):
                 win = False
 